@@ -5,8 +5,7 @@ Context-aware controller for participant self-service across multiple domains
 (microfinance borrowers, coaching clients, internal team members)
 """
 
-import bcrypt
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 is_active = (not globals().get('b2c_id'))
 
@@ -28,14 +27,10 @@ def get_language(context_id, feature_key, variant='label'):
     Returns:
         The language string, or a fallback based on feature_key if not found
     """
-    lang = db(
-        (db.feature_language.context_id == context_id) &
-        (db.feature_language.feature_key == feature_key) &
-        (db.feature_language.language_variant == variant)
-    ).select(db.feature_language.language_value).first()
-    
+    lang = get_context_language(context_id).get((feature_key, variant))
+
     if lang:
-        return lang.language_value
+        return lang
     
     # Fallback to mechanic name if no language mapping exists
     fallback_map = {
@@ -84,37 +79,39 @@ def login():
     if form.accepts(request, session):
         username = form.vars.username
         password = form.vars.password
-        user = db(db.participant.username == username).select().first()
-
-        if user and user.password_hash:
-            try:
-                password_bytes = password.encode('utf-8')
-                hash_bytes = (user.password_hash.encode('utf-8')
-                            if isinstance(user.password_hash, str)
-                            else user.password_hash)
-
-                if bcrypt.checkpw(password_bytes, hash_bytes):
-                    session.participant_id = user.id
-                    session.participant_name = user.real_name
-                    session.participant_username = user.username
-                    session.context_id = user.context_id
-                    session.responsible_id = user.responsible_id
-                    
-                    # Load context and responsible entity names for UI
-                    context = db.context(user.context_id)
-                    responsible = db.responsible(user.responsible_id)
-                    session.context_name = context.display_name if context else "Unknown"
-                    session.responsible_name = responsible.name if responsible else "Unknown"
-                    
-                    redirect(URL('dashboard'))
-                else:
-                    response.flash = "Invalid username or password"
-            except Exception as e:
-                response.flash = "Login error. Please contact administrator."
-                print("Login error: %s" % str(e))
-            redirect(URL(args=request.args, vars=request.vars))
-        else:
-            response.flash = "Invalid username or password"
+        if login_rate_limited():
+            response.flash = "Too many login attempts, please try again in a minute"
+            return dict(form=form)
+
+        # Participant plus context and responsible names in one round-trip
+        row = db(db.participant.username == username).select(
+            db.participant.ALL,
+            db.context.display_name,
+            db.responsible.name,
+            left=[db.context.on(db.participant.context_id == db.context.id),
+                  db.responsible.on(db.participant.responsible_id == db.responsible.id)]
+        ).first()
+        user = row.participant if row else None
+
+        # Always runs one bcrypt check, even for unknown usernames
+        if check_password(password, user.password_hash if user else None):
+            # Upgrade hashes made with an outdated cost while we have the password
+            if password_needs_rehash(user.password_hash):
+                user.update_record(password_hash=hash_password(password))
+
+            session.participant_id = user.id
+            session.participant_name = user.real_name
+            session.participant_username = user.username
+            session.context_id = user.context_id
+            session.responsible_id = user.responsible_id
+
+            # Context and responsible entity names for UI
+            session.context_name = row.context.display_name or "Unknown"
+            session.responsible_name = row.responsible.name or "Unknown"
+
+            redirect(URL('dashboard'))
+
+        response.flash = "Invalid username or password"
     elif form.errors:
         response.flash = "Please fill in all fields"
 
@@ -142,6 +139,14 @@ def participant_requires_login(func):
     return wrapper
 
 
+def clear_dashboard_cache(participant_id):
+    """Drop the cached dashboard lists of a participant after a change"""
+    cache.ram('recent_signals:%s' % participant_id, None)
+    cache.ram('unread_instructions:%s' % participant_id, None)
+    # The responsible entity's overview counts this participant's signals and reads
+    clear_responsible_dashboard(session.responsible_id)
+
+
 @participant_requires_login
 def dashboard():
     participant_record = db.participant(session.participant_id)
@@ -168,30 +173,42 @@ def dashboard():
         (db.work_activity.context_id == session.context_id)
     ).select(orderby=~db.work_activity.is_active|db.work_activity.activity_name)
 
-    seven_days_ago = (datetime.now() - timedelta(days=7)).date()
-
-    recent_signals = db(
-        (db.execution_signal.participant_id == session.participant_id) &
-        (db.execution_signal.context_id == session.context_id) &
-        (db.execution_signal.signal_date >= seven_days_ago)
-    ).select(
-        db.execution_signal.ALL,
-        db.work_activity.activity_name,
-        left=db.work_activity.on(db.execution_signal.work_activity_id == db.work_activity.id),
-        orderby=~db.execution_signal.signal_date,
-        limitby=(0, 10)
+    seven_days_ago = (request.now - timedelta(days=7)).date()
+
+    # Short-lived per-participant cache for dashboard refreshes;
+    # cleared by create_signal() and read_instruction()
+    recent_signals = cache.ram(
+        'recent_signals:%s' % session.participant_id,
+        lambda: db(
+            (db.execution_signal.participant_id == session.participant_id) &
+            (db.execution_signal.context_id == session.context_id) &
+            (db.execution_signal.signal_date >= seven_days_ago)
+        ).select(
+            db.execution_signal.ALL,
+            db.work_activity.activity_name,
+            left=db.work_activity.on(db.execution_signal.work_activity_id == db.work_activity.id),
+            orderby=~db.execution_signal.signal_date,
+            limitby=(0, 10),
+            cacheable=True
+        ),
+        time_expire=10
     )
 
-    unread_instructions = db(
-        (db.instruction_recipient.participant_id == session.participant_id) &
-        (db.instruction_recipient.context_id == session.context_id) &
-        (db.instruction_recipient.is_read == False)
-    ).select(
-        db.instruction_recipient.ALL,
-        db.instruction.ALL,
-        left=db.instruction.on(db.instruction_recipient.instruction_id == db.instruction.id),
-        orderby=~db.instruction.created_on,
-        limitby=(0, 5)
+    unread_instructions = cache.ram(
+        'unread_instructions:%s' % session.participant_id,
+        lambda: db(
+            (db.instruction_recipient.participant_id == session.participant_id) &
+            (db.instruction_recipient.context_id == session.context_id) &
+            (db.instruction_recipient.is_read == False)
+        ).select(
+            db.instruction_recipient.ALL,
+            db.instruction.ALL,
+            left=db.instruction.on(db.instruction_recipient.instruction_id == db.instruction.id),
+            orderby=~db.instruction.created_on,
+            limitby=(0, 5),
+            cacheable=True
+        ),
+        time_expire=10
     )
 
     pending_responses = db(
@@ -211,10 +228,7 @@ def dashboard():
     metric1_label = get_language(session.context_id, 'metric_allocated', 'label') or "Allocated"
     metric2_label = get_language(session.context_id, 'metric_completed', 'label') or "Completed"
     
-    # Safety check for calculation: use 0 if values are None
-    borrowed = participant_record.amount_borrowed or 0
-    repaid = participant_record.amount_repaid_b2c_reported or 0
-    balance = borrowed - repaid
+    balance = participant_record.balance
 
     return dict(
         participant=participant_record,
@@ -319,13 +333,14 @@ def edit_work_activity():
 def delete_work_activity():
     """Delete a work activity"""
     activity_id = request.args(0, cast=int)
-    if activity_id:
-        activity = db.work_activity(activity_id)
-        if activity and activity.participant_id == session.participant_id:
-            db(db.work_activity.id == activity_id).delete()
-            work_activity_label = get_language(session.context_id, 'work_activity', 'label')
-            session.flash = "%s deleted" % work_activity_label
-            redirect(URL('work_activities'))
+    # Ownership is part of the DELETE; nothing is removed for other participants
+    if activity_id and db(
+        (db.work_activity.id == activity_id) &
+        (db.work_activity.participant_id == session.participant_id)
+    ).delete():
+        work_activity_label = get_language(session.context_id, 'work_activity', 'label')
+        session.flash = "%s deleted" % work_activity_label
+        redirect(URL('work_activities'))
 
     session.flash = "Invalid request"
     redirect(URL('work_activities'))
@@ -344,11 +359,15 @@ def signals():
     Signal tracking is universal - participants report execution status
     regardless of context (business performance, goal progress, task status).
     """
+    # Only the columns the history table renders
     signals = db(
         (db.execution_signal.participant_id == session.participant_id) &
         (db.execution_signal.context_id == session.context_id)
     ).select(
-        db.execution_signal.ALL,
+        db.execution_signal.id,
+        db.execution_signal.signal_date,
+        db.execution_signal.outcome,
+        db.execution_signal.note,
         db.work_activity.activity_name,
         left=db.work_activity.on(
             db.execution_signal.work_activity_id == db.work_activity.id
@@ -392,6 +411,7 @@ def create_signal():
     form.vars.context_id = session.context_id
 
     if form.process().accepted:
+        clear_dashboard_cache(session.participant_id)
         execution_signal_label = get_language(session.context_id, 'execution_signal', 'label')
         session.flash = "%s recorded successfully" % execution_signal_label
         redirect(URL('signals'))
@@ -419,6 +439,11 @@ def instructions():
     Instruction inbox is universal - participants receive messages
     from their responsible entity regardless of context.
     """
+    page_size = 20
+    page = get_page()
+
+    # Unread first, then read; newest first within each group. One row past
+    # the page is fetched to know whether a next page exists.
     instructions = db(
         (db.instruction_recipient.participant_id == session.participant_id) &
         (db.instruction_recipient.context_id == session.context_id)
@@ -426,13 +451,20 @@ def instructions():
         db.instruction_recipient.ALL,
         db.instruction.ALL,
         left=db.instruction.on(db.instruction_recipient.instruction_id == db.instruction.id),
-        orderby=~db.instruction.created_on
+        orderby=db.instruction_recipient.is_read|~db.instruction.created_on,
+        limitby=(page * page_size, (page + 1) * page_size + 1)
     )
+    has_next = len(instructions) > page_size
+    instructions = instructions[:page_size]
 
+    instruction_label = get_language(session.context_id, 'instruction', 'label')
     instruction_label_plural = get_language(session.context_id, 'instruction', 'label_plural')
 
     return dict(
         instructions=instructions,
+        page=page,
+        has_next=has_next,
+        instruction_label=instruction_label,
         instruction_label_plural=instruction_label_plural
     )
 
@@ -464,10 +496,6 @@ def read_instruction():
 
     instruction = db.instruction(instruction_id)
 
-    # Mark as read if not already read
-    if not recipient.is_read:
-        recipient.update_record(is_read=True, read_on=datetime.now())
-
     # Handle response submission
     response_form = None
     if instruction.response_template != 'NONE' and not recipient.response:
@@ -491,13 +519,22 @@ def read_instruction():
 
         if response_form and response_form.process(formname='response').accepted:
             response_value = str(response_form.vars.get('confirm') or response_form.vars.get('response'))
+            # Record the response and the read receipt in one UPDATE
             recipient.update_record(
+                is_read=True,
+                read_on=recipient.read_on or request.now,
                 response=response_value,
-                responded_on=datetime.now()
+                responded_on=request.now
             )
+            clear_dashboard_cache(session.participant_id)
             session.flash = "Response submitted"
             redirect(URL('read_instruction', args=[instruction_id]))
 
+    # Mark as read if not already read
+    if not recipient.is_read:
+        recipient.update_record(is_read=True, read_on=request.now)
+        clear_dashboard_cache(session.participant_id)
+
     instruction_label = get_language(session.context_id, 'instruction', 'label')
 
     return dict(
@@ -523,14 +560,27 @@ def flyers():
     - Coaching: success stories/testimonials
     - Internal org: project showcases
     """
+    page_size = 50
+    page = get_page()
+
+    # One row past the page tells whether a next page exists; the list
+    # never shows flyer content, so it is left out of the select
     flyers = db(
         (db.flyer.participant_id == session.participant_id) &
         (db.flyer.context_id == session.context_id)
-    ).select(orderby=~db.flyer.created_on)
+    ).select(
+        db.flyer.id, db.flyer.title, db.flyer.created_on, db.flyer.updated_on,
+        db.flyer.is_public, db.flyer.view_count,
+        orderby=~db.flyer.created_on,
+        limitby=(page * page_size, (page + 1) * page_size + 1)
+    )
+    has_next = len(flyers) > page_size
+    flyers = flyers[:page_size]
 
     flyer_label_plural = get_language(session.context_id, 'flyer', 'label_plural')
 
-    return dict(flyers=flyers, flyer_label_plural=flyer_label_plural)
+    return dict(flyers=flyers, page=page, has_next=has_next,
+                flyer_label_plural=flyer_label_plural)
 
 
 @participant_requires_login
@@ -571,6 +621,7 @@ def edit_flyer():
     form = SQLFORM(db.flyer, flyer)
 
     if form.process().accepted:
+        clear_public_flyer(flyer_id)
         flyer_label = get_language(session.context_id, 'flyer', 'label')
         session.flash = "%s updated successfully" % flyer_label
         redirect(URL('flyers'))
@@ -593,13 +644,15 @@ def edit_flyer():
 def delete_flyer():
     """Delete a flyer"""
     flyer_id = request.args(0, cast=int)
-    if flyer_id:
-        flyer = db.flyer(flyer_id)
-        if flyer and flyer.participant_id == session.participant_id:
-            db(db.flyer.id == flyer_id).delete()
-            flyer_label = get_language(session.context_id, 'flyer', 'label')
-            session.flash = "%s deleted" % flyer_label
-            redirect(URL('flyers'))
+    # Ownership is part of the DELETE; nothing is removed for other participants
+    if flyer_id and db(
+        (db.flyer.id == flyer_id) &
+        (db.flyer.participant_id == session.participant_id)
+    ).delete():
+        clear_public_flyer(flyer_id)
+        flyer_label = get_language(session.context_id, 'flyer', 'label')
+        session.flash = "%s deleted" % flyer_label
+        redirect(URL('flyers'))
 
     session.flash = "Invalid request"
     redirect(URL('flyers'))
@@ -609,30 +662,69 @@ def delete_flyer():
 # PUBLIC FLYER VIEW (No login required)
 # ---------------------------------------------------------------------
 
+def get_public_flyer(flyer_id):
+    """
+    Load a flyer together with its author for the public view.
+
+    The public page is hit on every QR scan and its content is the same for
+    all viewers, so the joined row is cached in RAM for a minute.
+    Edits and deletes drop the entry via clear_public_flyer().
+
+    Returns:
+        Row with .flyer and .participant, or None if the flyer does not exist
+    """
+    def load():
+        return db(db.flyer.id == flyer_id).select(
+            db.flyer.ALL,
+            db.participant.id,
+            db.participant.real_name,
+            left=db.participant.on(db.flyer.participant_id == db.participant.id),
+            cacheable=True
+        ).first()
+
+    return cache.ram('public_flyer:%s' % flyer_id, load, time_expire=60)
+
+
 def view_flyer():
+    # Public page does not use the session; don't create or rewrite one per scan
+    session.forget(response)
+
     flyer_id = request.args(0, cast=int)
     if not flyer_id:
         return dict(error="Flyer not found")
 
     # Pull the tracking ID from the URL if it exists
     # We'll use the name 'b2c_id' to satisfy the existing View logic
-    b2c_id = request.vars.b2c_id or None
+    # Anonymous input: keep it only if it is a plausible record id
+    b2c_id, error = IS_INT_IN_RANGE(1, 2 ** 31)(request.vars.b2c_id)
+    if error:
+        b2c_id = None
 
-    flyer = db.flyer(flyer_id)
-    if not flyer or not flyer.is_public:
+    row = get_public_flyer(flyer_id)
+    if not row or not row.flyer.is_public:
         return dict(error="Flyer not found or not public")
-
-    # Increment view count
-    flyer.update_record(view_count=flyer.view_count + 1)
-
-    # Track view in your new flyer_view table
-    db.flyer_view.insert(
-        flyer_id=flyer_id,
-        viewer_ip=request.client,
-        participant_id=b2c_id  # This maps the URL var to your DB column
-    )
-
-    participant = db.participant(flyer.participant_id)
+    flyer, participant = row.flyer, row.participant
+
+    # Conditional GET: a client revalidating an unchanged flyer gets a 304
+    # with no page rendering and no counted view (timestamps are server local
+    # time, shifted to GMT for the header)
+    modified = flyer.updated_on or flyer.created_on
+    if modified:
+        last_modified = (modified + (request.utcnow - request.now)).strftime(
+            '%a, %d %b %Y %H:%M:%S GMT')
+        response.headers['Last-Modified'] = last_modified
+        # Let browsers keep the page and revalidate it (web2py's default is no-store)
+        response.headers['Cache-Control'] = 'no-cache'
+        if request.env.http_if_modified_since == last_modified:
+            raise HTTP(304, **response.headers)
+
+    # HEAD requests (link checkers, crawlers) are not views
+    if request.env.request_method == 'HEAD':
+        return dict(flyer=flyer, participant=participant, error=None)
+
+    # Count the view and log it to flyer_view (buffered, written in batches)
+    # request.client is resolved once per request; cap at the IPv6 text length
+    log_flyer_view(flyer_id, (request.client or '')[:45], b2c_id)
 
     #return dict(
     #    flyer=flyer,
@@ -657,6 +749,8 @@ def profile():
     form = SQLFORM(db.participant, participant_record, fields=fields)
 
     if form.process().accepted:
+        # Name and username are listed on the responsible entity's overview
+        clear_responsible_dashboard(session.responsible_id)
         session.participant_name = form.vars.real_name
         response.flash = "Profile updated" # Use response.flash for immediate feedback
         redirect(URL('profile'))
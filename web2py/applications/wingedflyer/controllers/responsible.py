@@ -5,8 +5,7 @@ Context-aware controller for managing participants across multiple domains
 (microfinance, coaching, internal organizations)
 """
 
-import bcrypt
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 
 # ---------------------------------------------------------------------
@@ -29,14 +28,10 @@ def get_language(context_id, feature_key, variant='label'):
     Returns:
         The language string, or a fallback based on feature_key if not found
     """
-    lang = db(
-        (db.feature_language.context_id == context_id) &
-        (db.feature_language.feature_key == feature_key) &
-        (db.feature_language.language_variant == variant)
-    ).select(db.feature_language.language_value).first()
-    
+    lang = get_context_language(context_id).get((feature_key, variant))
+
     if lang:
-        return lang.language_value
+        return lang
     
     # Fallback to mechanic name if no language mapping exists
     fallback_map = {
@@ -75,34 +70,35 @@ def login():
     if form.accepts(request, session):
         username = form.vars.username
         password = form.vars.password
-        user = db(db.responsible.username == username).select().first()
-
-        if user and user.password_hash:
-            try:
-                password_bytes = password.encode('utf-8')
-                hash_bytes = (user.password_hash.encode('utf-8')
-                            if isinstance(user.password_hash, str)
-                            else user.password_hash)
-
-                if bcrypt.checkpw(password_bytes, hash_bytes):
-                    session.responsible_id = user.id
-                    session.responsible_name = user.name
-                    session.responsible_username = user.username
-                    session.context_id = user.context_id  # Store context in session
-                    
-                    # Load context display name for UI
-                    context = db.context(user.context_id)
-                    session.context_name = context.display_name if context else "Unknown"
-                    
-                    redirect(URL('dashboard'))
-                else:
-                    response.flash = "Invalid username or password"
-            except Exception as e:
-                response.flash = "Login error. Please contact administrator."
-                print("Login error: %s" % str(e))
-            redirect(URL(args=request.args, vars=request.vars))
-        else:
-            response.flash = "Invalid username or password"
+        if login_rate_limited():
+            response.flash = "Too many login attempts, please try again in a minute"
+            return dict(form=form)
+
+        # Responsible entity plus context name in one round-trip
+        row = db(db.responsible.username == username).select(
+            db.responsible.ALL,
+            db.context.display_name,
+            left=db.context.on(db.responsible.context_id == db.context.id)
+        ).first()
+        user = row.responsible if row else None
+
+        # Always runs one bcrypt check, even for unknown usernames
+        if check_password(password, user.password_hash if user else None):
+            # Upgrade hashes made with an outdated cost while we have the password
+            if password_needs_rehash(user.password_hash):
+                user.update_record(password_hash=hash_password(password))
+
+            session.responsible_id = user.id
+            session.responsible_name = user.name
+            session.responsible_username = user.username
+            session.context_id = user.context_id  # Store context in session
+
+            # Context display name for UI
+            session.context_name = row.context.display_name or "Unknown"
+
+            redirect(URL('dashboard'))
+
+        response.flash = "Invalid username or password"
     elif form.errors:
         response.flash = "Please fill in all fields"
 
@@ -130,6 +126,29 @@ def responsible_requires_login(func):
     return wrapper
 
 
+def get_owned_participant(participant_id):
+    """
+    Load a participant of the logged-in responsible entity and context.
+
+    Ownership is part of the query, so the check costs the same single
+    SELECT as loading the row. Redirects to the dashboard when the id is
+    missing or the participant belongs to someone else.
+    """
+    if not participant_id:
+        session.flash = "Invalid participant account"
+        redirect(URL('dashboard'))
+
+    participant_record = db(
+        (db.participant.id == participant_id) &
+        (db.participant.responsible_id == session.responsible_id) &
+        (db.participant.context_id == session.context_id)
+    ).select().first()
+    if not participant_record:
+        session.flash = "Unauthorized or account not found"
+        redirect(URL('dashboard'))
+    return participant_record
+
+
 # ---------------------------------------------------------------------
 # DASHBOARD
 # ---------------------------------------------------------------------
@@ -146,47 +165,63 @@ def dashboard():
     participant_label = get_language(session.context_id, 'participant', 'label')
     participant_label_plural = get_language(session.context_id, 'participant', 'label_plural')
 
-    participants = db(
-        (db.participant.responsible_id == session.responsible_id) &
-        (db.participant.context_id == session.context_id)
-    ).select(orderby=db.participant.real_name)
+    def load():
+        # Only the columns the overview table renders
+        participants = db(
+            (db.participant.responsible_id == session.responsible_id) &
+            (db.participant.context_id == session.context_id)
+        ).select(db.participant.id, db.participant.real_name, db.participant.username,
+                 orderby=db.participant.real_name, cacheable=True)
+
+        participant_data = []
+        seven_days_ago = (request.now - timedelta(days=7)).date()
+
+        # Per-participant counts in two grouped queries instead of three per participant
+        participant_ids = [p.id for p in participants]
+        worse_counts = {}
+        instruction_counts = {}
+        if participant_ids:
+            # 1. Recent Worse Signals
+            worse = db.execution_signal.id.count()
+            for row in db(
+                (db.execution_signal.participant_id.belongs(participant_ids)) &
+                (db.execution_signal.outcome == 'WORSE') &
+                (db.execution_signal.signal_date >= seven_days_ago)
+            ).select(db.execution_signal.participant_id, worse,
+                     groupby=db.execution_signal.participant_id):
+                worse_counts[row.execution_signal.participant_id] = row[worse]
+
+            # 2. Unread Instructions and 3. Pending Responses (instructions expecting one)
+            unread = (db.instruction_recipient.is_read == False).case(1, 0).sum()
+            pending = ((db.instruction_recipient.response == None) &
+                       (db.instruction.response_template != 'NONE')).case(1, 0).sum()
+            for row in db(
+                (db.instruction_recipient.participant_id.belongs(participant_ids)) &
+                (db.instruction.id == db.instruction_recipient.instruction_id)
+            ).select(db.instruction_recipient.participant_id, unread, pending,
+                     groupby=db.instruction_recipient.participant_id):
+                instruction_counts[row.instruction_recipient.participant_id] = (row[unread] or 0, row[pending] or 0)
+
+        for p in participants:
+            recent_worse = worse_counts.get(p.id, 0)
+            unread_instructions, pending_responses = instruction_counts.get(p.id, (0, 0))
+
+            participant_data.append({
+                'participant': p,
+                'recent_worse_signals': recent_worse,
+                'unread_instructions': unread_instructions,
+                'pending_responses': pending_responses,
+                'needs_attention': recent_worse > 2 or pending_responses > 0
+            })
+        return participant_data
+
+    # Counts tolerate a minute of staleness; writes from this controller
+    # and from participants drop the entry via clear_responsible_dashboard()
+    participant_data = cache.ram('responsible_dashboard:%s' % session.responsible_id,
+                                 load, time_expire=60)
 
-    participant_data = []
-    now = datetime.now()
-    seven_days_ago = (now - timedelta(days=7)).date()
-
-    for p in participants:
-        # 1. Recent Worse Signals
-        recent_worse = db(
-            (db.execution_signal.participant_id == p.id) &
-            (db.execution_signal.outcome == 'WORSE') &
-            (db.execution_signal.signal_date >= seven_days_ago)
-        ).count()
-
-        # 2. Unread Instructions
-        unread_instructions = db(
-            (db.instruction_recipient.participant_id == p.id) &
-            (db.instruction_recipient.is_read == False)
-        ).count()
-
-        # 3. Pending Responses (Fixed Join Query)
-        pending_responses = db(
-            (db.instruction_recipient.participant_id == p.id) &
-            (db.instruction_recipient.response == None) &
-            (db.instruction.id == db.instruction_recipient.instruction_id) &
-            (db.instruction.response_template != 'NONE')
-        ).count()
-
-        participant_data.append({
-            'participant': p,
-            'recent_worse_signals': recent_worse,
-            'unread_instructions': unread_instructions,
-            'pending_responses': pending_responses,
-            'needs_attention': recent_worse > 2 or pending_responses > 0
-        })
-    
     # Calculate if they can create more participants
-    current_count = len(participants)
+    current_count = len(participant_data)
     can_create = current_count < (responsible_record.participant_limit or 0)
 
     return dict(
@@ -229,6 +264,7 @@ def create_participant():
     form.vars.context_id = session.context_id
 
     if form.process().accepted:
+        clear_responsible_dashboard(session.responsible_id)
         session.flash = "%s account created successfully" % participant_label
         redirect(URL('participant', args=[form.vars.id]))
 
@@ -301,16 +337,18 @@ def compose_instruction():
     )
 
     if form.process().accepted:
+        v = form.vars
         # Use the helper function from db.py
         instruction_id = send_instruction_to_participants(
             responsible_id=session.responsible_id,
-            participant_ids=form.vars.recipients,
-            subject=form.vars.subject,
-            instruction_text=form.vars.instruction_text,
-            response_template=form.vars.response_template,
+            participant_ids=v.recipients,
+            subject=v.subject,
+            instruction_text=v.instruction_text,
+            response_template=v.response_template,
             sent_by=session.responsible_username,
             context_id=session.context_id
         )
+        clear_responsible_dashboard(session.responsible_id)
 
         session.flash = "%s sent successfully" % instruction_label
         redirect(URL('sent_instructions'))
@@ -331,26 +369,44 @@ def compose_instruction():
 def sent_instructions():
     """View all instructions sent by this responsible entity"""
     
+    page_size = 50
+    page = get_page()
+
+    # One row past the page tells whether a next page exists
     instructions = db(
         (db.instruction.responsible_id == session.responsible_id) &
         (db.instruction.context_id == session.context_id)
-    ).select(orderby=~db.instruction.created_on)
+    ).select(
+        orderby=~db.instruction.created_on,
+        limitby=(page * page_size, (page + 1) * page_size + 1)
+    )
+    has_next = len(instructions) > page_size
+    instructions = instructions[:page_size]
+
+    # Recipient statistics for all instructions in one grouped query
+    total = db.instruction_recipient.id.count()
+    read = (db.instruction_recipient.is_read == True).case(1, 0).sum()
+    responded = ((db.instruction_recipient.response != None) &
+                 (db.instruction_recipient.response != '')).case(1, 0).sum()
+
+    stats = {}
+    instruction_ids = [msg.id for msg in instructions]
+    if instruction_ids:
+        for row in db(db.instruction_recipient.instruction_id.belongs(instruction_ids)).select(
+            db.instruction_recipient.instruction_id, total, read, responded,
+            groupby=db.instruction_recipient.instruction_id
+        ):
+            stats[row.instruction_recipient.instruction_id] = (row[total], row[read] or 0, row[responded] or 0)
 
-    # For each instruction, get recipient statistics
     instruction_data = []
     for msg in instructions:
-        recipients = db(db.instruction_recipient.instruction_id == msg.id).select()
-
-        total_recipients = len(recipients)
-        read_count = sum(1 for r in recipients if r.is_read)
-        responded_count = sum(1 for r in recipients if r.response)
+        total_recipients, read_count, responded_count = stats.get(msg.id, (0, 0, 0))
 
         instruction_data.append({
             'instruction': msg,
             'total_recipients': total_recipients,
             'read_count': read_count,
-            'responded_count': responded_count,
-            'recipients': recipients
+            'responded_count': responded_count
         })
 
     instruction_label = get_language(session.context_id, 'instruction', 'label')
@@ -358,6 +414,8 @@ def sent_instructions():
 
     return dict(
         instruction_data=instruction_data,
+        page=page,
+        has_next=has_next,
         instruction_label=instruction_label,
         instruction_label_plural=instruction_label_plural
     )
@@ -417,14 +475,7 @@ def participant():
     The mechanics are universal; only language and metric interpretation vary.
     """
     participant_id = request.args(0, cast=int)
-    if not participant_id:
-        session.flash = "Invalid participant account"
-        redirect(URL('dashboard'))
-
-    participant_record = db.participant(participant_id)
-    if not participant_record or participant_record.responsible_id != session.responsible_id:
-        session.flash = "Unauthorized access"
-        redirect(URL('dashboard'))
+    participant_record = get_owned_participant(participant_id)
 
     # Get context-specific language
     participant_label = get_language(session.context_id, 'participant', 'label')
@@ -442,7 +493,7 @@ def participant():
     recent_signals = db(
         (db.execution_signal.participant_id == participant_id) &
         (db.execution_signal.context_id == session.context_id) &
-        (db.execution_signal.signal_date >= (datetime.now() - timedelta(days=30)).date())
+        (db.execution_signal.signal_date >= (request.now - timedelta(days=30)).date())
     ).select(
         db.execution_signal.ALL,
         db.work_activity.activity_name,
@@ -487,14 +538,15 @@ def participant():
     )
 
     if metrics_form.process().accepted:
+        v = metrics_form.vars
         participant_record.update_record(
-            amount_borrowed=metrics_form.vars.amount_borrowed,
-            amount_repaid_b2c_reported=metrics_form.vars.amount_repaid
+            amount_borrowed=v.amount_borrowed,
+            amount_repaid_b2c_reported=v.amount_repaid
         )
         session.flash = "Metrics updated"
         redirect(URL('participant', args=[participant_id]))
 
-    balance = participant_record.amount_borrowed - participant_record.amount_repaid_b2c_reported
+    balance = participant_record.balance
 
     return dict(
         participant=participant_record,
@@ -525,7 +577,7 @@ def signals_overview():
     Shows what participants are reporting about their execution.
     Identical mechanic across contexts; only labels differ.
     """
-    cutoff = (datetime.now() - timedelta(days=7)).date()
+    cutoff = (request.now - timedelta(days=7)).date()
 
     signals = db(
         (db.execution_signal.participant_id == db.participant.id) &
@@ -544,8 +596,13 @@ def signals_overview():
         orderby=~db.execution_signal.signal_date
     )
 
-    worse_signals = [s for s in signals if s.execution_signal.outcome == 'WORSE']
-    better_signals = [s for s in signals if s.execution_signal.outcome == 'BETTER']
+    # Bucket by outcome in a single pass over the rows
+    worse_signals, better_signals = [], []
+    buckets = {'WORSE': worse_signals, 'BETTER': better_signals}
+    for s in signals:
+        bucket = buckets.get(s.execution_signal.outcome)
+        if bucket is not None:
+            bucket.append(s)
 
     execution_signal_label_plural = get_language(session.context_id, 'execution_signal', 'label_plural')
 
@@ -565,20 +622,14 @@ def signals_overview():
 def edit_participant():
     """Edit participant profile"""
     participant_id = request.args(0, cast=int)
-    if not participant_id:
-        session.flash = "Invalid participant account"
-        redirect(URL('dashboard'))
-
-    participant_record = db.participant(participant_id)
-    if not participant_record or participant_record.responsible_id != session.responsible_id:
-        session.flash = "Unauthorized access"
-        redirect(URL('dashboard'))
+    participant_record = get_owned_participant(participant_id)
 
     form = SQLFORM(db.participant, participant_record,
                    fields=['real_name', 'username', 'password_hash', 'address',
                           'telephone', 'email', 'social_media'])
 
     if form.process().accepted:
+        clear_responsible_dashboard(session.responsible_id)
         participant_label = get_language(session.context_id, 'participant', 'label')
         session.flash = "%s profile updated" % participant_label
         redirect(URL('participant', args=[participant_id]))
@@ -609,29 +660,21 @@ def delete_participant():
     - Flyers
     """
     participant_id = request.args(0, cast=int)
-    if not participant_id:
-        session.flash = "Invalid participant account"
-        redirect(URL('dashboard'))
-
-    # Security check: Ensure this participant belongs to the logged-in responsible entity
-    participant_record = db(
-        (db.participant.id == participant_id) &
-        (db.participant.responsible_id == session.responsible_id) &
-        (db.participant.context_id == session.context_id)
-    ).select().first()
-    
-    if not participant_record:
-        session.flash = "Unauthorized or account not found"
-        redirect(URL('dashboard'))
+    get_owned_participant(participant_id)
 
     # Delete associated records in other tables
     db(db.work_activity.participant_id == participant_id).delete()
     db(db.execution_signal.participant_id == participant_id).delete()
     db(db.instruction_recipient.participant_id == participant_id).delete()
-    db(db.flyer.participant_id == participant_id).delete()
+    flyers = db(db.flyer.participant_id == participant_id)
+    flyer_ids = [r.id for r in flyers.select(db.flyer.id)]
+    flyers.delete()
+    for flyer_id in flyer_ids:
+        clear_public_flyer(flyer_id)
 
     # Finally, delete the participant
     db(db.participant.id == participant_id).delete()
+    clear_responsible_dashboard(session.responsible_id)
 
     participant_label = get_language(session.context_id, 'participant', 'label')
     session.flash = "%s account and all associated data deleted successfully" % participant_label
@@ -1,17 +1,62 @@
 from gluon.contrib.appconfig import AppConfig
 from gluon.tools import Auth
 import bcrypt
+import logging
 from datetime import datetime, timedelta
 
+import flyer_view_buffer
+
 # 1. LOAD CONFIGURATION FIRST
 configuration = AppConfig(reload=True)
 
+logger = logging.getLogger('web2py.app.wingedflyer')
+
 # 2. DEFINE THE DATABASE CONNECTION ONCE
 db = DAL(configuration.get('db.uri'),
          pool_size=configuration.get('db.pool_size'),
          migrate_enabled=configuration.get('db.migrate'),
          check_reserved=['all'])
 
+# Optional Redis session store: set [redis] host (and port) in appconfig.ini.
+# Without it web2py keeps its default file-based sessions. Sessions expire
+# after redis.session_expiry seconds of inactivity (default one day), since
+# no cleanup job runs for Redis as it does for session files.
+if configuration.get('redis.host'):
+    from gluon.contrib.redis_utils import RConn
+    from gluon.contrib.redis_session import RedisSession
+    sessiondb = RedisSession(redis_conn=RConn(host=configuration.get('redis.host'),
+                                              port=configuration.get('redis.port') or 6379),
+                             session_expiry=int(configuration.get('redis.session_expiry') or 86400))
+    session.connect(request, response, db=sessiondb)
+
+# Development aid: set app.query_log = true in appconfig.ini to log actions
+# that run the same SQL statement shape repeatedly (N+1 query patterns).
+# Runs as the end-of-request commit, so queries issued while rendering the
+# view and by actions that redirect are included.
+if configuration.get('app.query_log'):
+    import re
+
+    def log_repeated_queries(adapter, threshold=3):
+        """Warn about statements repeated with different literals in this request, then commit"""
+        try:
+            shapes = {}
+            for sql, elapsed in db._timings:
+                shape = re.sub(r"'[^']*'|\b\d+(\.\d+)?\b", '?', sql)
+                shapes[shape] = shapes.get(shape, 0) + 1
+            for shape, count in shapes.items():
+                if count >= threshold:
+                    logger.warning('%s/%s ran %d similar queries: %s',
+                                   request.controller, request.function, count, shape)
+        finally:
+            adapter.commit()
+
+    response.custom_commit = log_repeated_queries
+
+# Index DDL declared next to each table below and run once per process, only
+# while migrations are enabled (on PostgreSQL CREATE INDEX IF NOT EXISTS still
+# locks the table, so it must not run on every request)
+DB_INDEXES = []
+
 # Auth system
 auth = Auth(db)
 auth.define_tables(username=True, signature=False)
@@ -75,7 +120,7 @@ db.feature_language.language_variant.requires = IS_IN_SET(['label', 'label_plura
 db.feature_language.feature_key.requires = IS_IN_SET(['participant', 'responsible', 'instruction', 'execution_signal'])
 
 # Index for fast lookups by context and feature
-db.executesql('CREATE INDEX IF NOT EXISTS idx_feature_language_lookup ON feature_language(context_id, feature_key, language_variant);')
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_feature_language_lookup ON feature_language(context_id, feature_key, language_variant);')
 
 ############################################################
 # 1. RESPONSIBLE TABLE (formerly MFI)
@@ -115,19 +160,104 @@ db.responsible.email.requires = IS_EMPTY_OR(IS_EMAIL())
 db.responsible.participant_limit.requires = IS_INT_IN_RANGE(0, 10000)
 
 # Password Hashing Logic (preserved from original)
+# bcrypt cost for new hashes (auth.bcrypt_rounds in appconfig.ini, default 12);
+# hashes with another cost are upgraded on the next login
+BCRYPT_ROUNDS = int(configuration.get('auth.bcrypt_rounds') or 12)
+
 def hash_password(pwd):
     """Hash password using bcrypt if not already hashed"""
     if pwd and not pwd.startswith('$2b$'):
-        return bcrypt.hashpw(pwd.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        return bcrypt.hashpw(pwd.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
     return pwd
 
+def password_needs_rehash(pwd_hash):
+    """True if a stored bcrypt hash ($2b$<cost>$...) uses a cost other than BCRYPT_ROUNDS"""
+    try:
+        return int(pwd_hash.split('$')[2]) != BCRYPT_ROUNDS
+    except (AttributeError, IndexError, ValueError):
+        return True
+
+def dummy_password_hash():
+    """
+    Hash checked when the account is missing, so unknown usernames cost
+    the same bcrypt work as wrong passwords (no username timing oracle).
+    Made with BCRYPT_ROUNDS once per process, since models run on every request.
+    """
+    return cache.ram('dummy_password_hash:%s' % BCRYPT_ROUNDS,
+                     lambda: bcrypt.hashpw(b'x', bcrypt.gensalt(BCRYPT_ROUNDS)),
+                     time_expire=None)
+
+# bcrypt uses at most 72 bytes of a password; newer releases reject longer ones
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+def password_too_long(value):
+    """IS_EXPR check for password fields: error message if bcrypt cannot hash value"""
+    if value and len(value.encode('utf-8')) > BCRYPT_MAX_PASSWORD_BYTES:
+        return 'Password too long (max %d bytes)' % BCRYPT_MAX_PASSWORD_BYTES
+
+db.responsible.password_hash.requires = IS_EXPR(password_too_long)
+
+def check_password(pwd, pwd_hash):
+    """Verify a password against a stored bcrypt hash, always running bcrypt once"""
+    hash_bytes = pwd_hash.encode('utf-8') if pwd_hash else dummy_password_hash()
+    pwd_bytes = (pwd or '').encode('utf-8')
+    # An overlong password can never match, but still costs one bcrypt check
+    too_long = len(pwd_bytes) > BCRYPT_MAX_PASSWORD_BYTES
+    try:
+        ok = bcrypt.checkpw(b'x' if too_long else pwd_bytes, hash_bytes)
+    except ValueError:
+        # Malformed or legacy plaintext value in password_hash
+        logger.warning('Unusable password hash rejected at login')
+        ok = False
+    return ok and bool(pwd_hash) and not too_long
+
+# Login attempts allowed per client address in a fixed one-minute window,
+# counted from the first attempt, before bcrypt checks are refused
+# (auth.login_attempts in appconfig.ini)
+LOGIN_ATTEMPTS_PER_MINUTE = int(configuration.get('auth.login_attempts') or 10)
+
+# Reverse proxies whose X-Forwarded-For is trusted (auth.trusted_proxies in
+# appconfig.ini, comma separated). Behind a proxy remote_addr is the proxy
+# itself, which would put every user under one shared limit.
+TRUSTED_PROXIES = configuration.get('auth.trusted_proxies') or []
+if isinstance(TRUSTED_PROXIES, str):
+    TRUSTED_PROXIES = [p.strip() for p in TRUSTED_PROXIES.split(',') if p.strip()]
+
+def login_client_address():
+    """
+    Address a login attempt is counted against.
+
+    The socket peer, unless that is a trusted proxy: then the last
+    X-Forwarded-For entry, the one the proxy appended itself. request.client
+    is not used since it trusts the first entry, which the client sets.
+    """
+    addr = request.env.remote_addr
+    forwarded = request.env.http_x_forwarded_for
+    if forwarded and addr in TRUSTED_PROXIES:
+        addr = forwarded.split(',')[-1].strip()
+    return addr
+
+def login_rate_limited():
+    """Count a login attempt from this client; True once it is over the limit"""
+    # The counter lives in a list so updating it keeps the entry's creation
+    # time: the window expires a minute after the first attempt
+    attempts = cache.ram('login_attempts:%s' % login_client_address(),
+                         lambda: [0], time_expire=60)
+    attempts[0] += 1
+    return attempts[0] > LOGIN_ATTEMPTS_PER_MINUTE
+
 def encrypt_responsible_password(row):
     """Before insert: hash the password"""
     if 'password_hash' in row:
         row['password_hash'] = hash_password(row['password_hash'])
 
+def encrypt_updated_password(dbset, fields):
+    """Before update: hash the password if this update sets one"""
+    if fields.get('password_hash'):
+        fields['password_hash'] = hash_password(fields['password_hash'])
+
 db.responsible._before_insert.append(encrypt_responsible_password)
-db.responsible._before_update.append(lambda s, f: f.__setitem__('password_hash', hash_password(f.get('password_hash'))))
+db.responsible._before_update.append(encrypt_updated_password)
 
 ############################################################
 # 2. PARTICIPANT TABLE (formerly B2C/BORROWER)
@@ -177,6 +307,16 @@ db.define_table(
 db.participant.username.requires = [IS_NOT_EMPTY(), IS_NOT_IN_DB(db, 'participant.username')]
 db.participant.real_name.requires = IS_NOT_EMPTY()
 db.participant.email.requires = IS_EMPTY_OR(IS_EMAIL())
+db.participant.password_hash.requires = IS_EXPR(password_too_long)
+
+# Outstanding amount (allocated minus completed), computed once per selected row
+db.participant.balance = Field.Virtual(
+    'balance',
+    lambda row: (row.participant.amount_borrowed or 0) - (row.participant.amount_repaid_b2c_reported or 0)
+)
+
+# Index for a responsible entity's participant lists (sorted by name)
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_participant_responsible_name ON participant(responsible_id, context_id, real_name);')
 
 def validate_participant_limit(fields):
     """
@@ -207,6 +347,7 @@ def encrypt_participant_password(fields):
         fields['password_hash'] = hash_password(fields['password_hash'])
 
 db.participant._before_insert.append(encrypt_participant_password)
+db.participant._before_update.append(encrypt_updated_password)
 
 ############################################################
 # 3. WORK ACTIVITY
@@ -234,6 +375,9 @@ db.define_table(
     format='%(activity_name)s'
 )
 
+# Index for listing a participant's activities (active first)
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_work_activity_participant ON work_activity(participant_id, context_id, is_active);')
+
 ############################################################
 # 4. EXECUTION SIGNAL (formerly DAILY_SIGNAL)
 ############################################################
@@ -265,6 +409,12 @@ db.define_table(
 
 db.execution_signal.outcome.requires = IS_IN_SET(['BETTER', 'AS_EXPECTED', 'WORSE'])
 
+# Index for the per-participant signal history (filtered by participant, newest first)
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_execution_signal_participant_date ON execution_signal(participant_id, context_id, signal_date);')
+
+# Index for the responsible dashboard's recent WORSE signal counts
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_execution_signal_participant_outcome ON execution_signal(participant_id, outcome, signal_date);')
+
 ############################################################
 # 5. PAYMENT TRACKING (Commented - Context-Specific)
 ############################################################
@@ -352,6 +502,9 @@ db.define_table(
     format='%(subject)s'
 )
 
+# Index for a responsible entity's sent instructions (newest first)
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_instruction_responsible_created ON instruction(responsible_id, context_id, created_on);')
+
 db.define_table(
     'instruction_recipient',
     Field('instruction_id', 'reference instruction', notnull=True,
@@ -367,6 +520,12 @@ db.define_table(
     Field('created_on', 'datetime', default=request.now)
 )
 
+# Index for a participant's inbox split by read status
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_instruction_recipient_inbox ON instruction_recipient(participant_id, is_read, instruction_id);')
+
+# Index for the responsible dashboard's pending response counts
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_instruction_recipient_response ON instruction_recipient(participant_id, response);')
+
 ############################################################
 # 7. FLYER TABLES (Public Content Publishing)
 ############################################################
@@ -399,16 +558,64 @@ db.flyer.title.requires = [
 ]
 db.flyer.thecontent.requires = IS_NOT_EMPTY(error_message='Content required')
 
+# Index for a participant's flyer list (newest first)
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_flyer_participant_created ON flyer(participant_id, context_id, created_on);')
+
 db.define_table('flyer_view',
     Field('flyer_id', 'reference flyer', notnull=True),
     Field('viewer_ip', 'string'),
      Field('participant_id', 'reference participant'), 
     Field('viewed_on', 'datetime', default=request.now)
 )
+
+# Index for per-flyer view history by date
+DB_INDEXES.append('CREATE INDEX IF NOT EXISTS idx_flyer_view_flyer_viewed ON flyer_view(flyer_id, viewed_on);')
+
+def create_indexes():
+    """Run the DB_INDEXES statements and commit so their locks are released"""
+    for sql in DB_INDEXES:
+        db.executesql(sql)
+    db.commit()
+    return True
+
+if configuration.get('db.migrate'):
+    cache.ram('db_indexes_created', create_indexes, time_expire=None)
+
 ############################################################
 # 8. HELPER FUNCTIONS
 ############################################################
 
+def get_context_language(context_id):
+    """
+    Load every language mapping of a context in a single query.
+
+    Used by the controllers' get_language(). Pages look up many labels per
+    request, so the whole mapping is fetched once and kept in RAM for a few
+    minutes (it changes rarely).
+
+    Returns:
+        dict mapping (feature_key, language_variant) to language_value
+    """
+    def load():
+        rows = db(db.feature_language.context_id == context_id).select(
+            db.feature_language.feature_key,
+            db.feature_language.language_variant,
+            db.feature_language.language_value
+        )
+        return dict(((r.feature_key, r.language_variant), r.language_value) for r in rows)
+
+    return cache.ram('feature_language:%s' % context_id, load, time_expire=300)
+
+
+def get_page():
+    """
+    Zero-based page number from request.vars.page, 0 when missing or invalid.
+    Paginated actions pass it with has_next to views/pager.html.
+    """
+    page, error = IS_INT_IN_RANGE(0, 100000)(request.vars.page)
+    return 0 if error else page
+
+
 def send_instruction_to_participants(responsible_id, participant_ids, subject, instruction_text, response_template, sent_by, context_id):
     """
     Send an instruction from a responsible entity to multiple participants.
@@ -454,3 +661,105 @@ def send_instruction_to_participants(responsible_id, participant_ids, subject, i
         )
     
     return instruction_id
+
+
+
+def clear_responsible_dashboard(responsible_id):
+    """Drop the cached participant overview of a responsible entity after a change"""
+    cache.ram('responsible_dashboard:%s' % responsible_id, None)
+
+def clear_public_flyer(flyer_id):
+    """Invalidate the cached public view of a flyer (see participant.get_public_flyer)"""
+    cache.ram('public_flyer:%s' % flyer_id, None)
+
+# Pending flyer_view rows are flushed once either limit is reached
+FLYER_VIEW_FLUSH_SIZE = 50
+FLYER_VIEW_FLUSH_SECONDS = 30
+# Rows kept for a retry when a flush fails (e.g. database unavailable)
+FLYER_VIEW_BUFFER_MAX = 1000
+
+def log_flyer_view(flyer_id, viewer_ip, participant_id=None):
+    """
+    Record a public flyer view without a database write on every hit.
+
+    Views are buffered in process memory and written by flush_flyer_views
+    when the buffer is full or its oldest row is stale. A stale buffer is
+    also flushed by the next request of any kind (see the end of this
+    file); views still buffered when the process exits are lost.
+
+    Args:
+        flyer_id: ID of the viewed flyer
+        viewer_ip: Client address of the viewer
+        participant_id: Optional tracking participant from the URL
+    """
+    # Shared by all requests of this process (modules/flyer_view_buffer.py)
+    buffer = flyer_view_buffer.rows
+
+    with flyer_view_buffer.lock:
+        buffer.append(dict(flyer_id=flyer_id, viewer_ip=viewer_ip,
+                           participant_id=participant_id, viewed_on=request.now))
+        oldest = buffer[0]['viewed_on']
+        if (len(buffer) < FLYER_VIEW_FLUSH_SIZE and
+                request.now - oldest < timedelta(seconds=FLYER_VIEW_FLUSH_SECONDS)):
+            return
+        pending = buffer[:]
+        del buffer[:]
+
+    flush_flyer_views(pending)
+
+def flush_stale_flyer_views():
+    """Flush buffered views whose oldest row has waited FLYER_VIEW_FLUSH_SECONDS"""
+    buffer = flyer_view_buffer.rows
+    if not buffer:
+        return
+
+    with flyer_view_buffer.lock:
+        if (not buffer or
+                request.now - buffer[0]['viewed_on'] < timedelta(seconds=FLYER_VIEW_FLUSH_SECONDS)):
+            return
+        pending = buffer[:]
+        del buffer[:]
+
+    flush_flyer_views(pending)
+
+def flush_flyer_views(pending):
+    """
+    Write buffered views and commit: one bulk_insert into flyer_view plus
+    one view_count increment per flyer. On failure the rows go back into
+    the buffer for the next flush.
+    """
+    try:
+        # Skip views of flyers deleted while their rows were buffered
+        flyer_ids = set(row['flyer_id'] for row in pending)
+        existing = set(r.id for r in db(db.flyer.id.belongs(flyer_ids)).select(db.flyer.id))
+        pending = [row for row in pending if row['flyer_id'] in existing]
+
+        # Tracking ids come from the URL; drop those of unknown participants
+        participant_ids = set(row['participant_id'] for row in pending) - set([None])
+        known = set(r.id for r in db(db.participant.id.belongs(participant_ids)).select(db.participant.id)) \
+            if participant_ids else set()
+        for row in pending:
+            if row['participant_id'] not in known:
+                row['participant_id'] = None
+        db.flyer_view.bulk_insert(pending)
+
+        views_per_flyer = {}
+        for row in pending:
+            views_per_flyer[row['flyer_id']] = views_per_flyer.get(row['flyer_id'], 0) + 1
+        for flyer_id, views in views_per_flyer.items():
+            # Keep updated_on: Last-Modified of the public page tracks edits, not views
+            db(db.flyer.id == flyer_id).update(view_count=db.flyer.view_count + views,
+                                               updated_on=db.flyer.updated_on)
+        # Commit here so a failing commit is retried with the rows re-buffered
+        db.commit()
+    except Exception:
+        # Keep the views for the next flush instead of failing this visitor's page
+        db.rollback()
+        logger.exception('Flushing %d buffered flyer views failed', len(pending))
+        with flyer_view_buffer.lock:
+            buffer = flyer_view_buffer.rows
+            buffer[:0] = pending
+            del buffer[:-FLYER_VIEW_BUFFER_MAX]
+
+# Runs on every request, so views reach the database on a quiet instance too
+flush_stale_flyer_views()
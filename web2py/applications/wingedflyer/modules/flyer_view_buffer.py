@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Per-process state for buffered flyer views (see log_flyer_view in models/db.py).
+
+Models are executed again on every request, so objects created there are not
+shared between requests. This module is imported once per process, which makes
+its list and lock the single buffer every request appends to.
+"""
+
+import threading
+
+# dicts ready for db.flyer_view.bulk_insert, oldest first
+rows = []
+lock = threading.Lock()